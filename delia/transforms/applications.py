@@ -3,14 +3,15 @@
     @Author:            Maxence Larose
 
     @Creation Date:     10/2022
-    @Last modification: 11/2022
+    @Last modification: 10/2026
 
     @Description:       This file contains the apply_transforms function which is used to apply transformations to
                         images and segmentations.
 """
 
-from copy import deepcopy
-from typing import Dict, Hashable, NamedTuple, Union
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Callable, Dict, Hashable, Iterator, List, Sequence, Set, Tuple, Union
 
 from monai.transforms import apply_transform as monai_apply_transform
 from monai.transforms import Compose, EnsureChannelFirstD
@@ -24,12 +25,6 @@ from delia.transforms.tools import convert_to_numpy, Mode, set_transforms_keys
 from delia.utils.data_model import PatientDataModel
 
 
-class _SitkImageInfo(NamedTuple):
-    spacing: tuple
-    origin: tuple
-    direction: tuple
-
-
 def apply_transforms(
         patient_dataset: PatientDataModel,
         transforms: Union[Compose, DataTransform, MonaiMapTransform, PhysicalSpaceTransform]
@@ -52,37 +47,110 @@ def apply_transforms(
     set_transforms_keys(patient_dataset=patient_dataset)
 
     if isinstance(transforms, Compose):
-        for t in transforms.transforms:
-            if isinstance(t, DataTransform):
-                _apply_data_transform(
-                    transform=t,
-                    patient_dataset=patient_dataset
-                )
-            elif isinstance(t, (PhysicalSpaceTransform, MonaiMapTransform)):
-                _apply_transform_on_segmentations(
-                    transform=t,
-                    patient_dataset=patient_dataset
-                )
-                _apply_transform_on_images(
-                    transform=t,
-                    patient_dataset=patient_dataset
-                )
+        transforms = _group_array_space_transforms(transforms=transforms.transforms)
     else:
-        if isinstance(transforms, DataTransform):
+        transforms = _group_array_space_transforms(transforms=[transforms])
+
+    images = _get_images(patient_dataset=patient_dataset)
+    has_segmentations = any(data.segmentations for data in patient_dataset.data)
+
+    for t in transforms:
+        if isinstance(t, DataTransform):
+            _set_images(images=images, patient_dataset=patient_dataset)
             _apply_data_transform(
-                transform=transforms,
-                patient_dataset=patient_dataset
-            )
-        elif isinstance(transforms, (PhysicalSpaceTransform, MonaiMapTransform)):
-            _apply_transform_on_segmentations(
-                transform=transforms,
+                transform=t,
                 patient_dataset=patient_dataset
             )
+            images = _get_images(patient_dataset=patient_dataset)
+            has_segmentations = any(data.segmentations for data in patient_dataset.data)
+        else:
+            if has_segmentations:
+                _apply_transform_on_segmentations(
+                    images=images,
+                    transform=t,
+                    patient_dataset=patient_dataset
+                )
             _apply_transform_on_images(
-                transform=transforms,
-                patient_dataset=patient_dataset
+                images=images,
+                transform=t
             )
 
+    _set_images(images=images, patient_dataset=patient_dataset)
+
+
+def _group_array_space_transforms(
+        transforms: Sequence[Union[DataTransform, MonaiMapTransform, PhysicalSpaceTransform]]
+) -> List[Union[Compose, DataTransform, PhysicalSpaceTransform]]:
+    """
+    Groups contiguous MonaiMapTransform into a single Compose so that the images are converted from SimpleITK images
+    to numpy arrays (and back) only once per group instead of once per transform.
+
+    Parameters
+    ----------
+    transforms : Sequence[Union[DataTransform, MonaiMapTransform, PhysicalSpaceTransform]]
+        A sequence of transformations.
+
+    Returns
+    -------
+    grouped_transforms : List[Union[Compose, DataTransform, PhysicalSpaceTransform]]
+        The transformations, where each run of contiguous array space transforms is replaced by a Compose.
+    """
+    grouped_transforms, array_space_transforms = [], []
+    for t in transforms:
+        if isinstance(t, (DataTransform, PhysicalSpaceTransform)):
+            if array_space_transforms:
+                grouped_transforms.append(_compose_array_space_transforms(transforms=array_space_transforms))
+                array_space_transforms = []
+
+            grouped_transforms.append(t)
+        elif isinstance(t, MonaiMapTransform):
+            array_space_transforms.append(t)
+
+    if array_space_transforms:
+        grouped_transforms.append(_compose_array_space_transforms(transforms=array_space_transforms))
+
+    return grouped_transforms
+
+
+def _compose_array_space_transforms(transforms: List[MonaiMapTransform]) -> Compose:
+    """
+    Composes MonaiMapTransform with the EnsureChannelFirstD transform they require. This is done once per
+    apply_transforms call so that the same Compose is reused for the images and for every segmentation.
+
+    Parameters
+    ----------
+    transforms : List[MonaiMapTransform]
+        A sequence of transformations to apply in the array space.
+
+    Returns
+    -------
+    compose : Compose
+        The composed transformations.
+    """
+    keys = list(dict.fromkeys(k for t in transforms for k in t.keys))
+    ensure_channel_first_d = _get_ensure_channel_first_d(keys=tuple(keys))
+
+    return Compose([ensure_channel_first_d, *transforms])
+
+
+@lru_cache(maxsize=None)
+def _get_ensure_channel_first_d(keys: Tuple[Hashable, ...]) -> EnsureChannelFirstD:
+    """
+    Gets the EnsureChannelFirstD transform for the given keys. EnsureChannelFirstD is stateless, so the same instance is
+    shared by every group of transforms that uses the same keys, including across patients.
+
+    Parameters
+    ----------
+    keys : Tuple[Hashable, ...]
+        Keys of the corresponding items to be transformed.
+
+    Returns
+    -------
+    ensure_channel_first_d : EnsureChannelFirstD
+        The EnsureChannelFirstD transform.
+    """
+    return EnsureChannelFirstD(keys=keys, allow_missing_keys=True)
+
 
 def _apply_data_transform(
         patient_dataset: PatientDataModel,
@@ -106,26 +174,22 @@ def _apply_data_transform(
     patient_dataset.data = list(transformed_data.values())
 
 
-def _apply_transform_on_images(
-        patient_dataset: PatientDataModel,
-        transform: Union[MonaiMapTransform, PhysicalSpaceTransform]
-) -> None:
+def _get_images(patient_dataset: PatientDataModel) -> Dict[str, ImageData]:
     """
-    Applies single transform on images.
+    Gets the patient's images, indexed by their transforms key.
 
     Parameters
     ----------
     patient_dataset : PatientDataModel
         A named tuple grouping the patient's data extracted from its DICOM files and the patient's medical image
         segmentation data extracted from the segmentation files.
-    transform : Union[MonaiMapTransform, PhysicalSpaceTransform]
-        A transformation to apply on images. PhysicalSpaceTransform are applied in the physical space, i.e on the
-        SimpleITK image, while MonaiMapTransform are applied in the array space, i.e on the numpy array that represents
-        the image. The keys for images are assumed to be the arbitrary series key set in 'tag_values'. For
-        segmentation, keys are organ names. Note that if 'tag_values' is None, the keys for images are
-        assumed to be modalities.
+
+    Returns
+    -------
+    images : Dict[str, ImageData]
+        A dictionary of the patient's images.
     """
-    images = {
+    return {
         data.image.transforms_key: ImageData(
             simple_itk_image=data.image.simple_itk_image,
             dicom_header=data.image.dicom_header
@@ -133,99 +197,180 @@ def _apply_transform_on_images(
         for data in patient_dataset.data
     }
 
-    transformed_images_dict = _apply_transform(transform=transform, data=images, mode=Mode.IMAGE)
+
+def _set_images(
+        images: Dict[str, ImageData],
+        patient_dataset: PatientDataModel
+) -> None:
+    """
+    Sets the patient's images to the given (transformed) images.
+
+    Parameters
+    ----------
+    images : Dict[str, ImageData]
+        A dictionary of the patient's images, indexed by their transforms key.
+    patient_dataset : PatientDataModel
+        A named tuple grouping the patient's data extracted from its DICOM files and the patient's medical image
+        segmentation data extracted from the segmentation files.
+    """
     for data in patient_dataset.data:
-        image = data.image
-        image.simple_itk_image = transformed_images_dict[image.transforms_key]
+        data.image.simple_itk_image = images[data.image.transforms_key].simple_itk_image
+
+
+def _apply_transform_on_images(
+        images: Dict[str, ImageData],
+        transform: Union[Compose, PhysicalSpaceTransform]
+) -> None:
+    """
+    Applies single transform on images.
+
+    Parameters
+    ----------
+    images : Dict[str, ImageData]
+        A dictionary of the patient's images, indexed by their transforms key. The dictionary is updated in place with
+        the transformed images.
+    transform : Union[Compose, PhysicalSpaceTransform]
+        A transformation to apply on images. PhysicalSpaceTransform are applied in the physical space, i.e on the
+        SimpleITK image, while a Compose of MonaiMapTransform is applied in the array space, i.e on the numpy array
+        that represents the image. The keys for images are assumed to be the arbitrary series key set in 'tag_values'.
+        For segmentation, keys are organ names. Note that if 'tag_values' is None, the keys for images are assumed to
+        be modalities.
+    """
+    transform_function = _get_transform_function(transform=transform)
+
+    with _transform_mode(transform=transform, mode=Mode.IMAGE):
+        transformed_images_dict = transform_function(transform=transform, data=images)
+
+    images.update({k: v._replace(simple_itk_image=transformed_images_dict[k]) for k, v in images.items()})
 
 
 def _apply_transform_on_segmentations(
+        images: Dict[str, ImageData],
         patient_dataset: PatientDataModel,
-        transform: Union[MonaiMapTransform, PhysicalSpaceTransform]
+        transform: Union[Compose, PhysicalSpaceTransform]
 ) -> None:
     """
     Applies single transform on segmentations.
 
     Parameters
     ----------
+    images : Dict[str, ImageData]
+        A dictionary of the patient's images, indexed by their transforms key.
     patient_dataset : PatientDataModel
         A named tuple grouping the patient's data extracted from its DICOM files and the patient's medical image
         segmentation data extracted from the segmentation files.
-    transform : Union[MonaiMapTransform, PhysicalSpaceTransform]
+    transform : Union[Compose, PhysicalSpaceTransform]
         A transformation to apply on segmentations. PhysicalSpaceTransform are applied in the physical space, i.e on the
-        SimpleITK image, while MonaiMapTransform are applied in the array space, i.e on the numpy array that represents
-        the image. Image keys are assumed to be arbitrary series keys defined in 'tag_values'. For the
-        label maps, the keys are organ names. Note that if 'tag_values' is None, the image keys are
-        assumed to be modality names.
+        SimpleITK image, while a Compose of MonaiMapTransform is applied in the array space, i.e on the numpy array
+        that represents the image. Image keys are assumed to be arbitrary series keys defined in 'tag_values'. For
+        the label maps, the keys are organ names. Note that if 'tag_values' is None, the image keys are assumed to be
+        modality names.
     """
-    images = {
-        data.image.transforms_key: ImageData(
-            simple_itk_image=data.image.simple_itk_image,
-            dicom_header=data.image.dicom_header
-        )
-        for data in patient_dataset.data
-    }
+    transform_keys = _get_transform_keys(transform=transform)
+    used_images = {k: v for k, v in images.items() if k in transform_keys}
+    transform_function = _get_transform_function(transform=transform)
 
-    for image_and_segmentation_data in patient_dataset.data:
-        segmentations = image_and_segmentation_data.segmentations
+    with _transform_mode(transform=transform, mode=Mode.SEGMENTATION):
+        for image_and_segmentation_data in patient_dataset.data:
+            segmentations = image_and_segmentation_data.segmentations
 
-        if segmentations:
-            for segmentation_data in segmentations:
-                temp_dict = deepcopy(images)
-                for organ_name, label_map in segmentation_data.simple_itk_label_maps.items():
-                    temp_dict[organ_name] = ImageData(simple_itk_image=label_map)
+            if segmentations:
+                for segmentation_data in segmentations:
+                    organ_names = list(segmentation_data.simple_itk_label_maps.keys())
 
-                transformed_dict = _apply_transform(transform=transform, data=temp_dict, mode=Mode.SEGMENTATION)
+                    temp_dict = used_images.copy()
+                    temp_dict.update(
+                        {k: ImageData(simple_itk_image=v) for k, v in segmentation_data.simple_itk_label_maps.items()}
+                    )
 
-                for img_key in images.keys():
-                    transformed_dict.pop(img_key)
+                    transformed_dict = transform_function(transform=transform, data=temp_dict)
 
-                segmentation_data.simple_itk_label_maps = transformed_dict
+                    segmentation_data.simple_itk_label_maps = {k: transformed_dict[k] for k in organ_names}
 
 
-def _apply_transform(
-        data: Dict[str, ImageData],
-        transform: Union[MonaiMapTransform, PhysicalSpaceTransform],
-        mode: Mode
-) -> Dict[Hashable, sitk.Image]:
+def _get_transform_function(
+        transform: Union[Compose, PhysicalSpaceTransform]
+) -> Callable[..., Dict[Hashable, sitk.Image]]:
     """
-    Applies single transform on segmentations.
+    Gets the function used to apply the given transform, so that the transform type is only checked once per pass
+    instead of once per image or segmentation.
 
     Parameters
     ----------
-    data : Dict[str, ImageData]
-        A Python dictionary that contains ImageData to be transformed.
-    transform : Union[MonaiMapTransform, PhysicalSpaceTransform]
+    transform : Union[Compose, PhysicalSpaceTransform]
         A transformation to apply. PhysicalSpaceTransform are applied in the physical space, i.e on the SimpleITK image,
-        while MonaiMapTransform are applied in the array space, i.e on the numpy array that represents the image. The
-        keys for images are assumed to be the arbitrary series key set in 'tag_values'. For segmentation,
-        keys are organ names. Note that if 'tag_values' is None, the keys for images are assumed to be
-        modalities.
-    mode : Mode
-        The mode.
+        while a Compose of MonaiMapTransform is applied in the array space, i.e on the numpy array that represents the
+        image.
 
     Returns
     -------
-    transformed_data : Dict[Hashable, sitk.Image]
-        A dictionary of transformed SimpleITK images.
+    transform_function : Callable[..., Dict[Hashable, sitk.Image]]
+        The function that applies the transform on a dictionary of ImageData.
     """
     if isinstance(transform, PhysicalSpaceTransform):
-        return _apply_physical_transform(transform=transform, data=data, mode=mode)
-    elif isinstance(transform, ArraySpaceTransform):
-        data = {k: v.simple_itk_image for k, v in data.items()}
-        return _apply_array_transform(transform=transform, data=data, mode=mode)
-    elif isinstance(transform, MonaiMapTransform):
-        data = {k: v.simple_itk_image for k, v in data.items()}
-        return _apply_monai_transforms(transform=transform, data=data)
+        return _apply_physical_transform
+    else:
+        return _apply_array_transforms
+
+
+def _get_transform_keys(transform: Union[Compose, PhysicalSpaceTransform]) -> Set[Hashable]:
+    """
+    Gets the keys of the items used by a PhysicalSpaceTransform, or by any of the MonaiMapTransform in a Compose.
+
+    Parameters
+    ----------
+    transform : Union[Compose, PhysicalSpaceTransform]
+        A transformation.
+
+    Returns
+    -------
+    transform_keys : Set[Hashable]
+        The keys used by the transform.
+    """
+    if isinstance(transform, Compose):
+        return {k for t in transform.transforms if isinstance(t, MonaiMapTransform) for k in t.keys}
+    else:
+        return set(transform.keys)
+
+
+@contextmanager
+def _transform_mode(
+        transform: Union[Compose, PhysicalSpaceTransform],
+        mode: Mode
+) -> Iterator[None]:
+    """
+    Sets the mode of a PhysicalSpaceTransform, or of every ArraySpaceTransform in a Compose, for the duration of the
+    context. The previous modes are restored on exit, even if the transform raises.
+
+    Parameters
+    ----------
+    transform : Union[Compose, PhysicalSpaceTransform]
+        A transformation.
+    mode : Mode
+        Mode.
+    """
+    if isinstance(transform, PhysicalSpaceTransform):
+        transforms = [transform]
+    else:
+        transforms = [t for t in transform.transforms if isinstance(t, ArraySpaceTransform)]
+
+    previous_modes = [t.mode for t in transforms]
+    for t in transforms:
+        t.mode = mode.value
+
+    try:
+        yield
+    finally:
+        for t, previous_mode in zip(transforms, previous_modes):
+            t.mode = previous_mode
 
 
 def _apply_physical_transform(
         data: Dict[str, ImageData],
-        transform: PhysicalSpaceTransform,
-        mode: Mode
+        transform: PhysicalSpaceTransform
 ) -> Dict[Hashable, sitk.Image]:
     """
-    Apply a PhysicalSpaceTransform.
+    Apply a PhysicalSpaceTransform. The transform mode must be set beforehand.
 
     Parameters
     ----------
@@ -234,18 +379,13 @@ def _apply_physical_transform(
     transform : PhysicalSpaceTransform
         A transformation to apply to images and segmentations in the physical space, i.e on the SimpleITK image. Keys
         are assumed to be modality names for images and organ names for segmentations.
-    mode : Mode
-        Mode.
 
     Returns
     -------
     transformed_data : Dict[Hashable, sitk.Image]
         A dictionary of transformed SimpleITK images.
     """
-    transform.mode = mode.value
-
     transformed_data = monai_apply_transform(transform=transform, data=data)
-    transform.mode = Mode.NONE.value
 
     for k, v in transformed_data.items():
         if isinstance(v, ImageData):
@@ -254,75 +394,73 @@ def _apply_physical_transform(
     return transformed_data
 
 
-def _apply_array_transform(
-        data: Dict[str, sitk.Image],
-        transform: ArraySpaceTransform,
-        mode: Mode
+def _apply_array_transforms(
+        data: Dict[str, ImageData],
+        transform: Compose
 ) -> Dict[Hashable, sitk.Image]:
     """
-    Apply a ArraySpaceTransform.
+    Apply a Compose of MonaiMapTransform, some of which may be ArraySpaceTransform. The mode of the
+    ArraySpaceTransform must be set beforehand.
 
     Parameters
     ----------
-    data : Dict[str, sitk.Image]
+    data : Dict[str, ImageData]
         A Python dictionary that contains ImageData to be transformed.
-    transform : ArraySpaceTransform
-        A transformation to apply to images and segmentations in the physical space, i.e on the SimpleITK image. Keys
-        are assumed to be modality names for images and organ names for segmentations.
-    mode : Mode
-        Mode.
+    transform : Compose
+        A sequence of transformations to apply to images and segmentations in the array space, i.e on the numpy array
+        that represents the image. Keys are assumed to be modality names for images and organ names for segmentations.
 
     Returns
     -------
     transformed_data : Dict[Hashable, sitk.Image]
         A dictionary of transformed SimpleITK images.
     """
-    transform.mode = mode.value
-    transformed_data = _apply_monai_transforms(data=data, transform=transform)
-    transform.mode = Mode.NONE.value
-
-    return transformed_data
+    return _apply_monai_transforms(data={k: v.simple_itk_image for k, v in data.items()}, transform=transform)
 
 
 def _apply_monai_transforms(
         data: Dict[str, sitk.Image],
-        transform: MonaiMapTransform
+        transform: Compose
 ) -> Dict[Hashable, sitk.Image]:
     """
-    Apply a MonaiMapTransform.
+    Apply a Compose of MonaiMapTransform, as built by _compose_array_space_transforms.
 
     Parameters
     ----------
     data : Dict[str, sitk.Image]
         A dictionary of SimpleITK images to be transformed.
-    transform : MonaiMapTransform
-        A transformation to apply to images and segmentations in the array space, i.e on the numpy array that
-        represents the image. Keys are assumed to be modality names for images and organ names for segmentations.
+    transform : Compose
+        A sequence of transformations to apply to images and segmentations in the array space, i.e on the numpy array
+        that represents the image. Keys are assumed to be modality names for images and organ names for segmentations.
 
     Returns
     -------
     transformed_data : Dict[Hashable, sitk.Image]
         A dictionary of transformed SimpleITK images.
     """
-    ensure_channel_first_d = EnsureChannelFirstD(keys=transform.keys, allow_missing_keys=True)
-    transform = Compose([ensure_channel_first_d, transform])
+    transform_keys = _get_transform_keys(transform=transform)
 
-    info = {}
+    spacings, origins, directions = {}, {}, {}
     temp_dict = {}
     for k, img in data.items():
-        info[k] = _SitkImageInfo(spacing=img.GetSpacing(), origin=img.GetOrigin(), direction=img.GetDirection())
-        temp_dict[k] = sitk.GetArrayFromImage(data[k])
+        if k in transform_keys:
+            spacings[k] = img.GetSpacing()
+            origins[k] = img.GetOrigin()
+            directions[k] = img.GetDirection()
+            temp_dict[k] = sitk.GetArrayFromImage(img)
 
+    # The Compose is applied even when no key is used, since ArraySpaceTransform may reset their state when called.
     transformed_data = monai_apply_transform(transform=transform, data=temp_dict)
 
     for k, img in transformed_data.items():
         transformed_img_array = convert_to_numpy(transformed_data[k])
 
         transformed_img_sitk = sitk.GetImageFromArray(transformed_img_array)
-        transformed_img_sitk.SetSpacing(info[k].spacing)
-        transformed_img_sitk.SetOrigin(info[k].origin)
-        transformed_img_sitk.SetDirection(info[k].direction)
+        transformed_img_sitk.SetSpacing(spacings[k])
+        transformed_img_sitk.SetOrigin(origins[k])
+        transformed_img_sitk.SetDirection(directions[k])
 
         transformed_data[k] = transformed_img_sitk
 
-    return transformed_data
+    # Images that no transform uses are neither converted nor copied.
+    return {k: transformed_data.get(k, img) for k, img in data.items()}
@@ -3,7 +3,7 @@
     @Author:            Maxence Larose
 
     @Creation Date:     10/2022
-    @Last modification: 10/2022
+    @Last modification: 10/2026
 
     @Description:       This file contains some tools to help applying transforms on images.
 """
@@ -12,7 +12,6 @@ from enum import IntEnum
 from typing import Union
 
 from monai.data import MetaTensor
-from monai.utils import convert_to_numpy as monai_convert_to_numpy
 import numpy as np
 
 from delia.utils.data_model import PatientDataModel
@@ -69,6 +68,7 @@ def convert_to_numpy(array: Union[MetaTensor, np.ndarray]) -> np.ndarray:
         Image numpy array.
     """
     if isinstance(array, MetaTensor):
-        return monai_convert_to_numpy(array[0, :])
+        # Indexing the plain tensor skips the MetaTensor metadata handling and, on CPU, numpy() shares its memory.
+        return np.ascontiguousarray(array.as_tensor()[0].detach().cpu().numpy())
     else:
         return array